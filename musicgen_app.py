@@ -3,15 +3,34 @@ import requests
 import json
 import time
 import os
-from typing import Dict, Any
-from dotenv import load_dotenv
+import io
+import base64
+import hashlib
+import uuid
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Set
 
-# Load environment variables from .env file (for local development)
-load_dotenv()
+# Load environment variables from .env file (for local development);
+# containers get them from Modal secrets, so they skip importing dotenv
+if modal.is_local():
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # Create Modal app
 app = modal.App("audic-musicgen")
 
+# Point HuggingFace, torch hub and audiocraft caches at the mounted model cache volume
+CACHE_DIR = "/cache_volume"
+CACHE_ENV = {
+    "HF_HOME": f"{CACHE_DIR}/hf",
+    "TORCH_HOME": f"{CACHE_DIR}/torch",
+    "XDG_CACHE_HOME": f"{CACHE_DIR}/xdg",
+    "AUDIOCRAFT_CACHE_DIR": f"{CACHE_DIR}/audiocraft",
+}
+
 # Define the image with required dependencies
 image = modal.Image.from_registry("python:3.11-slim").apt_install("git", "gcc", "ffmpeg").pip_install([
     "requests",
@@ -19,8 +38,28 @@ image = modal.Image.from_registry("python:3.11-slim").apt_install("git", "gcc",
     "boto3",
     "python-dotenv",
     "transformers",
+    "bitsandbytes",
     "git+https://github.com/facebookresearch/audiocraft.git"
-])
+]).env(CACHE_ENV)  # Reuse downloaded weights from the mounted cache volume
+
+# Slim image for functions that only forward requests or report status; torch and audiocraft are not
+# installed there, so the imports below fail fast and are skipped instead of loading at cold start
+web_image = modal.Image.debian_slim(python_version="3.11").pip_install("requests", "fastapi[standard]")
+
+# Same packages as image but a separate image, so a missing dependency reaches health_check's
+# import probe instead of failing the container while the module is imported
+health_image = image.env({"MUSICGEN_HEALTH_CHECK": "1"})
+
+# Heavy dependencies are imported once per container; only containers running image (the GPU
+# service and batch function) raise if they are missing
+with image.imports():
+    import torch
+    import torchaudio
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from audiocraft.models import MusicGen
+    from audiocraft.data.audio import audio_read
+    from audiocraft.data.audio_utils import normalize_audio
 
 def validate_environment():
     """Validate required environment variables"""
@@ -42,176 +81,600 @@ def validate_environment():
 # Define cache volume for model storage
 model_cache = modal.Volume.from_name("model-cache", create_if_missing=True)
 
-@app.function(image=image, gpu="A10G", timeout=600, volumes={"/cache_volume": model_cache}, secrets=[modal.Secret.from_name("aws-credentials"), modal.Secret.from_name("huggingface-token")])
-@modal.fastapi_endpoint()
-def generate_music(prompt: str, duration: int = 30, model_size: str = "large", message_deduplication_id: str = None) -> Dict[str, Any]:
+# Precision of the MusicGen LM weights (generation already runs under FP16 autocast on GPU)
+LM_DTYPE = "float16"
+
+# Batched requests are grouped by duration rounded up to this many seconds so they can share one generate call
+DURATION_BUCKET_SECONDS = 5
+
+# Length of the single short generation run at container start to initialize CUDA kernels and the default model
+WARMUP_DURATION = 1
+
+# Supported MusicGen checkpoints and the one preloaded when a container starts
+VALID_MODEL_SIZES = ["small", "medium", "large", "melody"]
+VALID_QUANTIZATIONS = ["none", "int8"]
+DEFAULT_MODEL_SIZE = "large"
+
+# Approximate VRAM footprint of each model in GB: the FP16 LM plus the FP32 T5 text encoder and EnCodec
+# (and the melody model's demucs stem splitter), which are offloaded together with it
+MODEL_VRAM_GB = {"small": 1.7, "medium": 4.1, "large": 7.7, "melody": 4.4}
+
+# Share of the footprint left after int8 quantization of the LM (embeddings, attention in-projections, norms,
+# T5 and EnCodec keep their precision)
+INT8_VRAM_RATIO = 0.65
+
+# VRAM available to resident models; the rest of the A10G is left for activations and the KV cache
+MODEL_VRAM_BUDGET_GB = 12.0
+
+# Prompts whose text conditioning (T5 forward) is cached per model
+CONDITION_CACHE_SIZE = 128
+
+# Recent generations kept so their duration can be extended with resume_from
+GENERATION_CACHE_SIZE = 32
+
+# In-flight inputs per MusicGenService container: generations run one at a time, so a second input
+# only overlaps its encoding and S3 upload; more would queue behind the GPU instead of scaling out
+SERVICE_MAX_INPUTS = 2
+
+# In-flight requests per web endpoint container, which only forwards to MusicGenService
+ENDPOINT_MAX_INPUTS = 8
+
+# Concurrent requests coalesced into a single generate call by generate_music_batch
+MAX_BATCH_SIZE = 8
+BATCH_WAIT_MS = 200
+
+# Multipart settings for uploading generated audio to S3
+S3_MULTIPART_THRESHOLD = 5 * 1024 * 1024
+S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+S3_MAX_CONCURRENCY = 10
+IO_POOL_WORKERS = 4
+
+# Lifetime of the presigned GET URLs returned to callers, in seconds
+PRESIGNED_URL_EXPIRES_IN = 3600
+
+# Loaded models (least recently used first) and clients, kept for the lifetime of the container
+_models: "OrderedDict[str, Any]" = OrderedDict()
+_models_on_gpu: Set[str] = set()
+_generations: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_compiled_forwards: Dict[str, Any] = {}
+_aws_config: Optional[Dict[str, str]] = None
+_s3_client = None
+_transfer_config = None
+
+# Serializes model loading and generation between concurrent inputs of one container
+_gpu_lock = threading.Lock()
+
+# boto3 client creation from the default session is not thread-safe, and I/O pool workers may race to it
+_s3_client_lock = threading.Lock()
+
+# Encoding and S3 uploads run here so they overlap with GPU generation
+_io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=IO_POOL_WORKERS)
+
+def bucket_duration(duration: int) -> int:
+    """Round duration up to the nearest DURATION_BUCKET_SECONDS"""
+    return -(-duration // DURATION_BUCKET_SECONDS) * DURATION_BUCKET_SECONDS
+
+class ConditionCache:
     """
-    Generate music using MusicGen model
+    LRU cache of a model's text conditioning, keyed by a hash of the prompts
+    
+    Installs itself over the condition provider's tokenize/forward so repeated prompts skip the T5 forward.
+    Melody (wav) conditions are never cached.
+    """
+    
+    def __init__(self, condition_provider, maxsize: int = CONDITION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._cache: "OrderedDict[str, Any]" = OrderedDict()
+        # (tokenized, key) from the latest tokenize call; holding the object itself means a stale
+        # entry can never match a later tokenized dict, even one that reuses its id
+        self._pending: Optional[tuple] = None
+        self._lock = threading.Lock()
+        self._tokenize = condition_provider.tokenize
+        self._forward = condition_provider.forward
+        condition_provider.tokenize = self.tokenize
+        condition_provider.forward = self.forward
+    
+    def tokenize(self, inputs):
+        tokenized = self._tokenize(inputs)
+        self._pending = None
+        if not any(attributes.wav for attributes in inputs):
+            # Null (classifier-free guidance) conditions show up as None texts, so they are part of the key
+            key = hashlib.sha1(repr([attributes.text for attributes in inputs]).encode()).hexdigest()
+            self._pending = (tokenized, key)
+        return tokenized
+    
+    def forward(self, tokenized):
+        pending, self._pending = self._pending, None
+        if pending is None or pending[0] is not tokenized:
+            return self._forward(tokenized)
+        key = pending[1]
+        
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        
+        condition_tensors = self._forward(tokenized)
+        with self._lock:
+            self._cache[key] = condition_tensors
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return condition_tensors
+
+def model_key(model_size: str, quantization: str = "none") -> str:
+    """Cache key for a model size and quantization mode, e.g. large or large-int8"""
+    return model_size if quantization == "none" else f"{model_size}-{quantization}"
+
+def model_vram_gb(key: str) -> float:
+    """Approximate VRAM footprint of a cached model"""
+    model_size, _, quantization = key.partition("-")
+    return MODEL_VRAM_GB[model_size] * (INT8_VRAM_RATIO if quantization == "int8" else 1.0)
+
+def quantize_lm_int8(model):
+    """Swap the LM's nn.Linear layers for bitsandbytes int8 layers; embeddings and norms stay in FP16"""
+    import bitsandbytes as bnb
+    
+    for name, module in list(model.lm.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if not isinstance(child, torch.nn.Linear):
+                continue
+            
+            int8_linear = bnb.nn.Linear8bitLt(child.in_features, child.out_features, bias=child.bias is not None, has_fp16_weights=False)
+            int8_linear.weight = bnb.nn.Int8Params(child.weight.data.cpu(), requires_grad=False, has_fp16_weights=False)
+            if child.bias is not None:
+                int8_linear.bias = torch.nn.Parameter(child.bias.data.cpu(), requires_grad=False)
+            # Moving to the GPU is what quantizes the weights
+            setattr(module, child_name, int8_linear.cuda())
+
+def move_model(model, device: str):
+    """Move the LM, EnCodec and the conditioners' encoders of a model to device"""
+    model.lm.to(device)
+    model.compression_model.to(device)
+    for conditioner in model.lm.condition_provider.conditioners.values():
+        # T5Conditioner and the melody conditioner keep their encoders in __dict__, so lm.to() does not move them
+        for name in ("t5", "demucs"):
+            if name in conditioner.__dict__:
+                conditioner.__dict__[name].to(device)
+
+def offload_models_for(key: str):
+    """Move least recently used models to CPU until key fits in MODEL_VRAM_BUDGET_GB"""
+    used = sum(model_vram_gb(other) for other in _models_on_gpu if other != key)
+    for victim in list(_models):
+        if used + model_vram_gb(key) <= MODEL_VRAM_BUDGET_GB:
+            break
+        if victim == key or victim not in _models_on_gpu:
+            continue
+        
+        if victim.endswith("-int8"):
+            # bitsandbytes int8 weights cannot round-trip through CPU, so drop the model instead
+            print(f"🗑️  Dropping MusicGen {victim} model...")
+            del _models[victim]
+        else:
+            print(f"📤 Offloading MusicGen {victim} model to CPU...")
+            move_model(_models[victim], "cpu")
+            # The compiled forward is specialized on the old weight device, so recompile after the next reload
+            _models[victim].lm.__dict__.pop("forward", None)
+        _compiled_forwards.pop(victim, None)
+        _models_on_gpu.discard(victim)
+        used -= model_vram_gb(victim)
+    
+    torch.cuda.empty_cache()
+
+def get_model(model_size: str, compile: bool = False, quantization: str = "none"):
+    """
+    Return the MusicGen model for model_size, loading it on first use
+    
+    Models stay cached in the container; when switching sizes would exceed the VRAM budget,
+    the least recently used ones are offloaded to CPU rather than dropped.
     
     Args:
-        prompt: Text description of the music to generate
-        duration: Duration in seconds (1-300)
-        model_size: Model size - "small", "medium", "large", "melody" (default: "large" for best quality)
+        model_size: Model size - "small", "medium", "large", "melody"
+        compile: Wrap the LM forward with torch.compile; shapes are dynamic because the KV cache grows every decoding step
+        quantization: LM weight quantization - "none" (FP16) or "int8" (bitsandbytes)
+    """
+    key = model_key(model_size, quantization)
+    if key not in _models_on_gpu:
+        offload_models_for(key)
+    
+    model = _models.get(key)
+    if model is None:
+        print(f"🌐 Loading MusicGen {key} model...")
+        for cache_path in CACHE_ENV.values():
+            os.makedirs(cache_path, exist_ok=True)
+        model = MusicGen.get_pretrained(f'facebook/musicgen-{model_size}')
+        # Halve LM weight bandwidth and memory; EnCodec stays in FP32 to avoid decode artifacts
+        model.lm.to(dtype=getattr(torch, LM_DTYPE))
+        if quantization == "int8":
+            quantize_lm_int8(model)
+        model.condition_cache = ConditionCache(model.lm.condition_provider)
+        _models[key] = model
+        # Persist freshly downloaded weights so later cold starts read them from the volume
+        model_cache.commit()
+    elif key not in _models_on_gpu:
+        print(f"📥 Moving MusicGen {key} model back to GPU...")
+        move_model(model, "cuda")
+    
+    _models_on_gpu.add(key)
+    _models.move_to_end(key)
+    
+    if compile:
+        if key not in _compiled_forwards:
+            print(f"⚙️  Compiling MusicGen {key} decoder...")
+            model.lm.__dict__.pop("forward", None)
+            # No CUDA Graphs: each captured graph is tied to one KV cache length, so they would be re-recorded every step
+            _compiled_forwards[key] = torch.compile(model.lm.forward, fullgraph=False, dynamic=True)
+        model.lm.forward = _compiled_forwards[key]
+    else:
+        # Drop the instance override so the eager nn.Module forward is used again
+        model.lm.__dict__.pop("forward", None)
+    
+    return model
+
+def get_aws_config() -> Dict[str, str]:
+    """Return the AWS settings, read from the environment once per container"""
+    global _aws_config
+    if _aws_config is None:
+        env = os.environ
+        _aws_config = {
+            "access_key_id": env.get('AWS_ACCESS_KEY_ID'),
+            "secret_access_key": env.get('AWS_SECRET_ACCESS_KEY'),
+            "region": env.get('AWS_REGION', 'us-east-1'),
+            "bucket_name": env.get('S3_BUCKET_NAME_MUSIC', 'audic-sfx'),
+        }
+    return _aws_config
+
+def get_s3_client():
+    """Return the S3 client, created once per container so its connection pool is reused"""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                aws_config = get_aws_config()
+                _s3_client = boto3.client(
+                    's3',
+                    aws_access_key_id=aws_config["access_key_id"],
+                    aws_secret_access_key=aws_config["secret_access_key"],
+                    region_name=aws_config["region"]
+                )
+    return _s3_client
+
+def get_transfer_config():
+    """Return the multipart TransferConfig used for concurrent S3 uploads"""
+    global _transfer_config
+    if _transfer_config is None:
+        with _s3_client_lock:
+            if _transfer_config is None:
+                _transfer_config = TransferConfig(
+                    multipart_threshold=S3_MULTIPART_THRESHOLD,
+                    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                    max_concurrency=S3_MAX_CONCURRENCY,
+                    use_threads=True
+                )
+    return _transfer_config
+
+def validate_request(prompt: str, duration: int, model_size: str, quantization: str = "none") -> Optional[str]:
+    """Return an error message if the generation parameters are invalid, otherwise None"""
+    if model_size not in VALID_MODEL_SIZES:
+        return f"Invalid model size. Must be one of: {', '.join(VALID_MODEL_SIZES)}"
+    
+    if quantization not in VALID_QUANTIZATIONS:
+        return f"Invalid quantization. Must be one of: {', '.join(VALID_QUANTIZATIONS)}"
+    
+    if not isinstance(duration, int) or isinstance(duration, bool):
+        return "Duration must be a whole number of seconds"
+    
+    if duration < 1 or duration > 300:
+        return "Duration must be between 1 and 300 seconds"
+    
+    if not isinstance(prompt, str):
+        return "Prompt must be a string"
+    
+    if not prompt.strip():
+        return "Prompt cannot be empty"
+    
+    return None
+
+def encode_wav(audio_tensor, sampling_rate: int) -> bytes:
+    """Loudness-normalize audio and encode it as 16-bit PCM WAV bytes, like audio_write but without touching disk"""
+    if audio_tensor.ndim == 1:
+        audio_tensor = audio_tensor[None]
+    
+    audio_tensor = normalize_audio(audio_tensor, strategy="loudness", loudness_compressor=True, sample_rate=sampling_rate)
+    
+    buffer = io.BytesIO()
+    torchaudio.save(buffer, audio_tensor, sampling_rate, format="wav", encoding="PCM_S", bits_per_sample=16)
+    return buffer.getvalue()
+
+def save_and_upload_music(audio_values, sampling_rate: int, prompt: str, duration: int, model_size: str, message_deduplication_id: str = None, include_base64: bool = False, filename_suffix: str = "", melody_path: str = None) -> Dict[str, Any]:
+    """
+    Encode generated audio to WAV and upload it to S3, returning a presigned URL to fetch it
+    
+    Args:
+        audio_values: Generated audio tensor for a single prompt
+        sampling_rate: Sample rate of the generated audio
+        prompt: Prompt the audio was generated from
+        duration: Requested duration in seconds
+        model_size: Model size used for generation
         message_deduplication_id: Optional message deduplication ID for unique S3 file naming
+        include_base64: Also return the WAV inline as base64 (always done if the S3 upload fails)
+        filename_suffix: Appended to the filename to keep outputs of one batch apart
+        melody_path: Reference melody the audio was conditioned on, if any
     """
+    label = "music with melody" if melody_path else "music"
+    name_prefix = "_melody" if melody_path else ""
+    
+    # Ensure audio is in the correct format (float32, mono) and on the CPU; no numpy round-trip is needed
+    audio_tensor = audio_values
+    if audio_tensor.ndim > 1:
+        audio_tensor = audio_tensor.mean(dim=0)  # Convert stereo to mono if needed
+    audio_tensor = audio_tensor.cpu()
+    
+    print(f"✅ {label.capitalize()} generated successfully! Sample rate: {sampling_rate}Hz")
+    
+    # Name the file using message_deduplication_id
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    
+    if message_deduplication_id:
+        filename = f"musicgen{name_prefix}_{message_deduplication_id}_{timestamp}{filename_suffix}"
+        print(f"📁 Using message_deduplication_id for filename: {message_deduplication_id}")
+    else:
+        filename = f"generated_music{name_prefix}_{timestamp}{filename_suffix}"
+        print("⚠️  No message_deduplication_id provided, using default filename pattern")
+    
+    # Encode in memory so the S3 upload (and optional base64 payload) never touch disk
+    wav_filename = f"{filename}.wav"
+    audio_bytes = encode_wav(audio_tensor, sampling_rate)
+    
+    print(f"💾 Encoded in memory: {wav_filename}")
+    
+    result = {
+        "success": True,
+        "sampling_rate": sampling_rate,
+        "duration": duration,
+        "format": "wav",
+        "filename": wav_filename,
+        "file_size_bytes": len(audio_bytes),
+        "prompt_used": prompt,
+        "model_size": model_size,
+        "message_deduplication_id": message_deduplication_id
+    }
+    if melody_path:
+        result["melody_path"] = melody_path
+    
+    # Upload to S3
     try:
-        # Validate environment variables
-        if not validate_environment():
-            return {"error": "Missing AWS credentials. Please run setup_modal_secrets.py or use Modal secrets"}
-        
-        from audiocraft.models import MusicGen
-        from audiocraft.data.audio import audio_write
-        import torch
-        import base64
-        import io
-        import numpy as np
-        from datetime import datetime
-        
-        # Get Hugging Face token if available
-        hf_token = os.getenv('HUGGING_FACE_TOKEN')
-        
-        # Validate model size
-        valid_models = ["small", "medium", "large", "melody"]
-        if model_size not in valid_models:
-            return {"error": f"Invalid model size. Must be one of: {', '.join(valid_models)}"}
-        
-        # Load MusicGen model with optional token and error handling
-        try:
-            print(f"🌐 Loading MusicGen {model_size} model...")
-            model = MusicGen.get_pretrained(f'facebook/musicgen-{model_size}')
-        except Exception as model_error:
-            print(f"❌ Failed to load MusicGen model: {model_error}")
-            return {"error": f"Model loading failed: {str(model_error)}"}
-        
-        # Validate duration
-        if duration < 1 or duration > 300:
-            return {"error": "Duration must be between 1 and 300 seconds"}
-        
-        # Validate prompt
-        if not prompt or not prompt.strip():
-            return {"error": "Prompt cannot be empty"}
-        
-        model.set_generation_params(duration=duration)
-        
-        print(f"🎵 Generating {duration}-second music...")
-        print(f"📝 Prompt: {prompt[:100]}{'...' if len(prompt) > 100 else ''}")
+        s3_client = get_s3_client()
         
-        # Generate music using MusicGen with error handling
-        try:
-            wav = model.generate([prompt])  # generates music for the prompt
-        except Exception as gen_error:
-            print(f"❌ Music generation failed: {gen_error}")
-            return {"error": f"Music generation failed: {str(gen_error)}"}
-        
-        # Get the first (and only) generated audio
-        audio_values = wav[0]  # MusicGen returns a list of generated samples
-        
-        # Convert to numpy array if it's a tensor
-        if torch.is_tensor(audio_values):
-            audio_values = audio_values.cpu().numpy()
-        
-        # Ensure audio is in the correct format (float32, mono)
-        if audio_values.ndim > 1:
-            audio_values = audio_values.mean(axis=0)  # Convert stereo to mono if needed
-        
-        sampling_rate = model.sample_rate
-        print(f"✅ Music generated successfully! Sample rate: {sampling_rate}Hz")
-        
-        # Save the file using the recommended audio_write function with message_deduplication_id
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        bucket_name = get_aws_config()["bucket_name"]
         
+        # Organize S3 structure with message_deduplication_id
         if message_deduplication_id:
-            filename = f"musicgen_{message_deduplication_id}_{timestamp}"
-            print(f"📁 Using message_deduplication_id for filename: {message_deduplication_id}")
+            s3_key = f"musicgen_{message_deduplication_id}_{wav_filename}"
         else:
-            filename = f"generated_music_{timestamp}"
-            print("⚠️  No message_deduplication_id provided, using default filename pattern")
+            s3_key = f"audio_{wav_filename}"
         
-        # Use audio_write as recommended in the documentation
-        # Convert to tensor if it's a numpy array
-        if isinstance(audio_values, np.ndarray):
-            audio_tensor = torch.from_numpy(audio_values)
-        else:
-            audio_tensor = audio_values.cpu()
+        s3_client.upload_fileobj(io.BytesIO(audio_bytes), bucket_name, s3_key, Config=get_transfer_config())
         
-        audio_write(filename, audio_tensor, sampling_rate, strategy="loudness", loudness_compressor=True)
+        # Generate S3 URI (internal path) and a presigned URL so callers can fetch the audio directly
+        s3_uri = f"s3://{bucket_name}/{s3_key}"
+        presigned_url = s3_client.generate_presigned_url('get_object', Params={'Bucket': bucket_name, 'Key': s3_key}, ExpiresIn=PRESIGNED_URL_EXPIRES_IN)
         
-        # The file is saved with .wav extension by audio_write
-        wav_filename = f"{filename}.wav"
+        print(f"✅ {label.capitalize()} uploaded to S3: {s3_uri}")
         
-        # Read the file back for base64 encoding
-        with open(wav_filename, 'rb') as f:
-            audio_bytes = f.read()
+        result.update({
+            "s3_uri": s3_uri,
+            "s3_bucket": bucket_name,
+            "s3_key": s3_key,
+            "presigned_url": presigned_url
+        })
         
-        # Convert to base64 for transmission
-        audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
+        if include_base64:
+            result["audio_base64"] = base64.b64encode(audio_bytes).decode('utf-8')
         
-        print(f"💾 Saved locally: {wav_filename}")
+        return result
         
-        # Upload to S3
+    except Exception as s3_error:
+        print(f"⚠️  S3 upload failed: {s3_error}")
+        # Return the audio inline without S3 info if upload fails
+        result["audio_base64"] = base64.b64encode(audio_bytes).decode('utf-8')
+        return result
+
+@app.cls(image=image, gpu="A10G", timeout=600, volumes={CACHE_DIR: model_cache}, secrets=[modal.Secret.from_name("aws-credentials"), modal.Secret.from_name("huggingface-token")])
+@modal.concurrent(max_inputs=SERVICE_MAX_INPUTS)
+class MusicGenService:
+    """MusicGen models kept loaded on the GPU across warm invocations of a container"""
+    
+    @modal.enter()
+    def load(self):
+        """Preload the default model and S3 client once when the container starts"""
+        model = get_model(DEFAULT_MODEL_SIZE)
+        get_s3_client()
+        
+        # One short eager generation initializes CUDA libraries and the T5 and EnCodec paths before the first request
+        print(f"🔥 Warming up MusicGen {DEFAULT_MODEL_SIZE}...")
+        model.set_generation_params(duration=WARMUP_DURATION)
+        with torch.inference_mode():
+            model.generate(["warmup"])
+    
+    @modal.method()
+    def generate(self, prompt: str, duration: int = 30, model_size: str = "large", message_deduplication_id: str = None, compile: bool = False, include_base64: bool = False, quantization: str = "none", resume_from: str = None) -> Dict[str, Any]:
+        """
+        Generate music using MusicGen model
+        
+        Args:
+            prompt: Text description of the music to generate
+            duration: Duration in seconds (1-300)
+            model_size: Model size - "small", "medium", "large", "melody" (default: "large" for best quality)
+            message_deduplication_id: Optional message deduplication ID for unique S3 file naming
+            compile: Compile the decoder with torch.compile (default: False)
+            include_base64: Also return the WAV inline as base64 (default: False, use presigned_url)
+            quantization: LM weight quantization - "none" (FP16) or "int8" (default: "none")
+            resume_from: generation_id of an earlier, shorter generation of the same prompt to extend instead of starting over
+        """
         try:
-            import boto3
+            # Validate environment variables
+            if not validate_environment():
+                return {"error": "Missing AWS credentials. Please run setup_modal_secrets.py or use Modal secrets"}
+            
+            # Get Hugging Face token if available
+            hf_token = os.getenv('HUGGING_FACE_TOKEN')
             
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-                region_name=os.getenv('AWS_REGION', 'us-east-1')
-            )
+            # Validate model size, duration and prompt
+            validation_error = validate_request(prompt, duration, model_size, quantization)
+            if validation_error:
+                return {"error": validation_error}
             
-            bucket_name = os.getenv('S3_BUCKET_NAME_MUSIC', 'audic-sfx')
+            # Models carry per-call streaming state, so only one input drives the GPU at a time;
+            # concurrent inputs still overlap their encoding and S3 uploads with this section
+            with _gpu_lock:
+                # Load MusicGen model with optional token and error handling
+                try:
+                    model = get_model(model_size, compile=compile, quantization=quantization)
+                except Exception as model_error:
+                    print(f"❌ Failed to load MusicGen model: {model_error}")
+                    return {"error": f"Model loading failed: {str(model_error)}"}
+                
+                model.set_generation_params(duration=duration)
+                
+                print(f"🎵 Generating {duration}-second music...")
+                print(f"📝 Prompt: {prompt[:100]}{'...' if len(prompt) > 100 else ''}")
+                
+                # Look up the earlier generation to extend
+                previous_audio = None
+                if resume_from:
+                    previous = _generations.get(resume_from)
+                    if previous is None:
+                        return {"error": f"Unknown or expired generation to resume from: {resume_from}"}
+                    if previous["model_key"] != model_key(model_size, quantization) or previous["prompt"] != prompt:
+                        return {"error": "resume_from must refer to a generation with the same prompt, model size and quantization"}
+                    if previous["audio"].shape[-1] >= duration * model.sample_rate:
+                        return {"error": "Duration must be longer than the generation being resumed"}
+                    previous_audio = previous["audio"]
+                    print(f"⏩ Resuming from generation {resume_from}")
+                
+                # Generate music using MusicGen with error handling
+                try:
+                    with torch.inference_mode():
+                        if previous_audio is not None:
+                            # audiocraft rejects prompts longer than max_duration, so a longer clip is continued from its
+                            # last max_duration - extend_stride seconds and the earlier audio is joined back on
+                            kept_samples = 0
+                            if previous_audio.shape[-1] > model.max_duration * model.sample_rate:
+                                kept_samples = previous_audio.shape[-1] - int((model.max_duration - model.extend_stride) * model.sample_rate)
+                                model.set_generation_params(duration=duration - kept_samples / model.sample_rate)
+                            
+                            # The prompt audio is re-encoded and prefilled in one pass; only the new tokens are decoded step by step
+                            wav = model.generate_continuation(previous_audio[None, ..., kept_samples:], model.sample_rate, [prompt])
+                            wav = torch.cat([previous_audio[None, ..., :kept_samples].to(wav.device), wav], dim=-1)
+                        else:
+                            wav = model.generate([prompt])  # generates music for the prompt
+                except Exception as gen_error:
+                    print(f"❌ Music generation failed: {gen_error}")
+                    return {"error": f"Music generation failed: {str(gen_error)}"}
+                
+                # Get the first (and only) generated audio
+                audio_values = wav[0]  # MusicGen returns a list of generated samples
             
-            # Organize S3 structure with message_deduplication_id
-            if message_deduplication_id:
-                s3_key = f"musicgen_{message_deduplication_id}_{wav_filename}"
-            else:
-                s3_key = f"audio_{wav_filename}"
+            # Remember the generation so a later request can extend it; kept on the CPU so it stays outside the
+            # VRAM budget (generate_continuation moves it back to the GPU)
+            generation_id = uuid.uuid4().hex
+            _generations[generation_id] = {"model_key": model_key(model_size, quantization), "prompt": prompt, "audio": audio_values.cpu()}
+            if len(_generations) > GENERATION_CACHE_SIZE:
+                _generations.popitem(last=False)
             
-            s3_client.upload_file(wav_filename, bucket_name, s3_key)
+            result = save_and_upload_music(audio_values, model.sample_rate, prompt, duration, model_size, message_deduplication_id, include_base64)
+            result["generation_id"] = generation_id
+            return result
             
-            # Generate S3 URI (internal path)
-            s3_uri = f"s3://{bucket_name}/{s3_key}"
+        except Exception as e:
+            print(f"❌ Unexpected error: {e}")
+            return {"error": str(e)}
+    
+    @modal.method()
+    def generate_with_melody(self, prompt: str, melody_path: str, duration: int = 30, message_deduplication_id: str = None, compile: bool = False, include_base64: bool = False, quantization: str = "none") -> Dict[str, Any]:
+        """
+        Generate music using MusicGen Melody model with a reference melody
+        
+        Args:
+            prompt: Text description of the music to generate
+            melody_path: Path to reference melody audio file
+            duration: Duration in seconds (1-300)
+            message_deduplication_id: Optional message deduplication ID for unique S3 file naming
+            compile: Compile the decoder with torch.compile (default: False)
+            include_base64: Also return the WAV inline as base64 (default: False, use presigned_url)
+            quantization: LM weight quantization - "none" (FP16) or "int8" (default: "none")
+        """
+        try:
+            # Validate environment variables
+            if not validate_environment():
+                return {"error": "Missing AWS credentials. Please run setup_modal_secrets.py or use Modal secrets"}
             
-            print(f"✅ Music uploaded to S3: {s3_uri}")
+            # Validate duration, prompt and quantization
+            validation_error = validate_request(prompt, duration, "melody", quantization)
+            if validation_error:
+                return {"error": validation_error}
             
-            return {
-                "success": True,
-                "audio_base64": audio_base64,
-                "sampling_rate": sampling_rate,
-                "duration": duration,
-                "format": "wav",
-                "filename": wav_filename,
-                "file_size_bytes": len(audio_bytes),
-                "s3_uri": s3_uri,
-                "s3_bucket": bucket_name,
-                "s3_key": s3_key,
-                "prompt_used": prompt,
-                "model_size": model_size,
-                "message_deduplication_id": message_deduplication_id
-            }
+            # Load reference melody
+            try:
+                melody, sr = audio_read(melody_path)
+                print(f"🎼 Loaded reference melody: {melody_path}")
+            except Exception as melody_error:
+                print(f"❌ Failed to load melody: {melody_error}")
+                return {"error": f"Melody loading failed: {str(melody_error)}"}
             
-        except Exception as s3_error:
-            print(f"⚠️  S3 upload failed: {s3_error}")
-            # Return without S3 info if upload fails
-            return {
-                "success": True,
-                "audio_base64": audio_base64,
-                "sampling_rate": sampling_rate,
-                "duration": duration,
-                "format": "wav",
-                "filename": wav_filename,
-                "file_size_bytes": len(audio_bytes),
-                "prompt_used": prompt,
-                "model_size": model_size,
-                "message_deduplication_id": message_deduplication_id
-            }
-        
-    except Exception as e:
-        print(f"❌ Unexpected error: {e}")
-        return {"error": str(e)}
+            # Models carry per-call streaming state, so only one input drives the GPU at a time;
+            # concurrent inputs still overlap their encoding and S3 uploads with this section
+            with _gpu_lock:
+                # Load MusicGen Melody model
+                try:
+                    model = get_model("melody", compile=compile, quantization=quantization)
+                except Exception as model_error:
+                    print(f"❌ Failed to load MusicGen Melody model: {model_error}")
+                    return {"error": f"Model loading failed: {str(model_error)}"}
+                
+                model.set_generation_params(duration=duration)
+                
+                print(f"🎵 Generating {duration}-second music with melody...")
+                print(f"📝 Prompt: {prompt[:100]}{'...' if len(prompt) > 100 else ''}")
+                
+                # Generate music using MusicGen Melody with error handling
+                try:
+                    with torch.inference_mode():
+                        wav = model.generate_with_chroma([prompt], melody[None].expand(1, -1, -1), sr)
+                except Exception as gen_error:
+                    print(f"❌ Music generation failed: {gen_error}")
+                    return {"error": f"Music generation failed: {str(gen_error)}"}
+                
+                # Get the first (and only) generated audio
+                audio_values = wav[0]  # MusicGen returns a list of generated samples
+            
+            return save_and_upload_music(audio_values, model.sample_rate, prompt, duration, "melody", message_deduplication_id, include_base64, melody_path=melody_path)
+            
+        except Exception as e:
+            print(f"❌ Unexpected error: {e}")
+            return {"error": str(e)}
 
-@app.function(image=image, gpu="A10G", timeout=600, volumes={"/cache_volume": model_cache}, secrets=[modal.Secret.from_name("aws-credentials"), modal.Secret.from_name("huggingface-token")])
-def generate_music_with_melody(prompt: str, melody_path: str, duration: int = 30, message_deduplication_id: str = None) -> Dict[str, Any]:
+@app.function(image=web_image, timeout=600)
+@modal.concurrent(max_inputs=ENDPOINT_MAX_INPUTS)
+@modal.fastapi_endpoint()
+async def generate_music(prompt: str, duration: int = 30, model_size: str = "large", message_deduplication_id: str = None, compile: bool = False, include_base64: bool = False, quantization: str = "none", resume_from: str = None) -> Dict[str, Any]:
+    """
+    Generate music using MusicGen model
+    
+    Args:
+        prompt: Text description of the music to generate
+        duration: Duration in seconds (1-300)
+        model_size: Model size - "small", "medium", "large", "melody" (default: "large" for best quality)
+        message_deduplication_id: Optional message deduplication ID for unique S3 file naming
+        compile: Compile the decoder with torch.compile (default: False)
+        include_base64: Also return the WAV inline as base64 (default: False, use presigned_url)
+        quantization: LM weight quantization - "none" (FP16) or "int8" (default: "none")
+        resume_from: generation_id of an earlier, shorter generation of the same prompt to extend instead of starting over
+    """
+    return await MusicGenService().generate.remote.aio(prompt, duration, model_size, message_deduplication_id, compile, include_base64, quantization, resume_from)
+
+@app.function(image=web_image, timeout=600)
+def generate_music_with_melody(prompt: str, melody_path: str, duration: int = 30, message_deduplication_id: str = None, compile: bool = False, include_base64: bool = False, quantization: str = "none") -> Dict[str, Any]:
     """
     Generate music using MusicGen Melody model with a reference melody
     
@@ -220,167 +683,99 @@ def generate_music_with_melody(prompt: str, melody_path: str, duration: int = 30
         melody_path: Path to reference melody audio file
         duration: Duration in seconds (1-300)
         message_deduplication_id: Optional message deduplication ID for unique S3 file naming
+        compile: Compile the decoder with torch.compile (default: False)
+        include_base64: Also return the WAV inline as base64 (default: False, use presigned_url)
+        quantization: LM weight quantization - "none" (FP16) or "int8" (default: "none")
     """
-    try:
-        # Validate environment variables
-        if not validate_environment():
-            return {"error": "Missing AWS credentials. Please run setup_modal_secrets.py or use Modal secrets"}
-        
-        from audiocraft.models import MusicGen
-        from audiocraft.data.audio import audio_write
-        import torch
-        import base64
-        import io
-        import numpy as np
-        from datetime import datetime
-        
-        # Load MusicGen Melody model
-        try:
-            print("🌐 Loading MusicGen Melody model...")
-            model = MusicGen.get_pretrained('facebook/musicgen-melody')
-        except Exception as model_error:
-            print(f"❌ Failed to load MusicGen Melody model: {model_error}")
-            return {"error": f"Model loading failed: {str(model_error)}"}
-        
-        # Validate duration
-        if duration < 1 or duration > 300:
-            return {"error": "Duration must be between 1 and 300 seconds"}
-        
-        # Validate prompt
-        if not prompt or not prompt.strip():
-            return {"error": "Prompt cannot be empty"}
-        
-        model.set_generation_params(duration=duration)
-        
-        print(f"🎵 Generating {duration}-second music with melody...")
-        print(f"📝 Prompt: {prompt[:100]}{'...' if len(prompt) > 100 else ''}")
-        
-        # Load reference melody
-        try:
-            from audiocraft.data.audio import audio_read
-            melody, sr = audio_read(melody_path)
-            print(f"🎼 Loaded reference melody: {melody_path}")
-        except Exception as melody_error:
-            print(f"❌ Failed to load melody: {melody_error}")
-            return {"error": f"Melody loading failed: {str(melody_error)}"}
-        
-        # Generate music using MusicGen Melody with error handling
-        try:
-            wav = model.generate_with_chroma([prompt], melody[None].expand(1, -1, -1), sr)
-        except Exception as gen_error:
-            print(f"❌ Music generation failed: {gen_error}")
-            return {"error": f"Music generation failed: {str(gen_error)}"}
-        
-        # Get the first (and only) generated audio
-        audio_values = wav[0]  # MusicGen returns a list of generated samples
-        
-        # Convert to numpy array if it's a tensor
-        if torch.is_tensor(audio_values):
-            audio_values = audio_values.cpu().numpy()
-        
-        # Ensure audio is in the correct format (float32, mono)
-        if audio_values.ndim > 1:
-            audio_values = audio_values.mean(axis=0)  # Convert stereo to mono if needed
-        
-        sampling_rate = model.sample_rate
-        print(f"✅ Music with melody generated successfully! Sample rate: {sampling_rate}Hz")
-        
-        # Save the file using the recommended audio_write function with message_deduplication_id
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        if message_deduplication_id:
-            filename = f"musicgen_melody_{message_deduplication_id}_{timestamp}"
-            print(f"📁 Using message_deduplication_id for melody filename: {message_deduplication_id}")
-        else:
-            filename = f"generated_music_melody_{timestamp}"
-            print("⚠️  No message_deduplication_id provided for melody, using default filename pattern")
-        
-        # Use audio_write as recommended in the documentation
-        # Convert to tensor if it's a numpy array
-        if isinstance(audio_values, np.ndarray):
-            audio_tensor = torch.from_numpy(audio_values)
-        else:
-            audio_tensor = audio_values.cpu()
-        
-        audio_write(filename, audio_tensor, sampling_rate, strategy="loudness", loudness_compressor=True)
-        
-        # The file is saved with .wav extension by audio_write
-        wav_filename = f"{filename}.wav"
-        
-        # Read the file back for base64 encoding
-        with open(wav_filename, 'rb') as f:
-            audio_bytes = f.read()
-        
-        # Convert to base64 for transmission
-        audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
-        
-        print(f"💾 Saved locally: {wav_filename}")
-        
-        # Upload to S3
+    return MusicGenService().generate_with_melody.remote(prompt, melody_path, duration, message_deduplication_id, compile, include_base64, quantization)
+
+@app.function(image=image, gpu="A10G", timeout=600, volumes={CACHE_DIR: model_cache}, secrets=[modal.Secret.from_name("aws-credentials"), modal.Secret.from_name("huggingface-token")])
+@modal.batched(max_batch_size=MAX_BATCH_SIZE, wait_ms=BATCH_WAIT_MS)
+def generate_music_batch(requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Generate music for several prompts with one model.generate call per model, quantization and duration bucket
+    
+    Concurrent calls are coalesced by Modal, so each caller passes a single request dict and gets a single result back.
+    
+    Args:
+        requests: Dicts with "prompt" and optional "duration", "model_size", "message_deduplication_id", "include_base64" and "quantization" keys
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(requests)
+    
+    # Validate environment variables
+    if not validate_environment():
+        return [{"error": "Missing AWS credentials. Please run setup_modal_secrets.py or use Modal secrets"}] * len(requests)
+    
+    # Group requests that can share a forward pass; requests come from unrelated callers,
+    # so a malformed one only fails its own slot
+    groups: Dict[tuple, List[int]] = {}
+    for i, request in enumerate(requests):
         try:
-            import boto3
-            
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-                region_name=os.getenv('AWS_REGION', 'us-east-1')
-            )
-            
-            bucket_name = os.getenv('S3_BUCKET_NAME_MUSIC', 'audic-sfx')
-            
-            # Organize S3 structure with message_deduplication_id
-            if message_deduplication_id:
-                s3_key = f"musicgen_{message_deduplication_id}_{wav_filename}"
-            else:
-                s3_key = f"audio_{wav_filename}"
+            prompt = request.get("prompt")
+            duration = request.get("duration", 30)
+            model_size = request.get("model_size", DEFAULT_MODEL_SIZE)
+            quantization = request.get("quantization", "none")
             
-            s3_client.upload_file(wav_filename, bucket_name, s3_key)
+            validation_error = validate_request(prompt, duration, model_size, quantization)
+            if validation_error:
+                results[i] = {"error": validation_error}
+                continue
             
-            # Generate S3 URI (internal path)
-            s3_uri = f"s3://{bucket_name}/{s3_key}"
-            
-            print(f"✅ Music with melody uploaded to S3: {s3_uri}")
-            
-            return {
-                "success": True,
-                "audio_base64": audio_base64,
-                "sampling_rate": sampling_rate,
-                "duration": duration,
-                "format": "wav",
-                "filename": wav_filename,
-                "file_size_bytes": len(audio_bytes),
-                "s3_uri": s3_uri,
-                "s3_bucket": bucket_name,
-                "s3_key": s3_key,
-                "prompt_used": prompt,
-                "model_size": "melody",
-                "melody_path": melody_path,
-                "message_deduplication_id": message_deduplication_id
-            }
+            groups.setdefault((model_size, quantization, bucket_duration(duration)), []).append(i)
+        except Exception as e:
+            print(f"❌ Invalid batch request: {e}")
+            results[i] = {"error": f"Invalid request: {str(e)}"}
+    
+    # Batch containers have no @modal.enter, so create the S3 client here before any upload is submitted
+    get_s3_client()
+    get_transfer_config()
+    
+    pending: Dict[int, concurrent.futures.Future] = {}
+    for (model_size, quantization, bucketed_duration), indices in groups.items():
+        try:
+            model = get_model(model_size, quantization=quantization)
+            model.set_generation_params(duration=bucketed_duration)
             
-        except Exception as s3_error:
-            print(f"⚠️  S3 upload failed: {s3_error}")
-            # Return without S3 info if upload fails
-            return {
-                "success": True,
-                "audio_base64": audio_base64,
-                "sampling_rate": sampling_rate,
-                "duration": duration,
-                "format": "wav",
-                "filename": wav_filename,
-                "file_size_bytes": len(audio_bytes),
-                "prompt_used": prompt,
-                "model_size": "melody",
-                "melody_path": melody_path,
-                "message_deduplication_id": message_deduplication_id
-            }
-        
-    except Exception as e:
-        print(f"❌ Unexpected error: {e}")
-        return {"error": str(e)}
+            print(f"🎵 Generating {len(indices)} x {bucketed_duration}-second music with MusicGen {model_size}...")
+            with torch.inference_mode():
+                wav = model.generate([requests[i]["prompt"] for i in indices])
+        except Exception as gen_error:
+            print(f"❌ Batch generation failed: {gen_error}")
+            for i in indices:
+                results[i] = {"error": f"Music generation failed: {str(gen_error)}"}
+            continue
+        
+        # Encode and upload on the I/O pool while the GPU moves on to the next group; outputs are copied
+        # to the CPU here so worker threads never touch CUDA tensors during the next generation
+        for audio_values, i in zip(wav, indices):
+            request = requests[i]
+            duration = request.get("duration", 30)
+            try:
+                pending[i] = _io_pool.submit(
+                    save_and_upload_music,
+                    audio_values[..., :int(duration * model.sample_rate)].cpu(),
+                    model.sample_rate,
+                    request["prompt"],
+                    duration,
+                    model_size,
+                    request.get("message_deduplication_id"),
+                    request.get("include_base64", False),
+                    filename_suffix=f"_{i}"
+                )
+            except Exception as e:
+                print(f"❌ Unexpected error: {e}")
+                results[i] = {"error": str(e)}
+    
+    for i, future in pending.items():
+        try:
+            results[i] = future.result()
+        except Exception as e:
+            print(f"❌ Unexpected error: {e}")
+            results[i] = {"error": str(e)}
+    
+    return results
 
-@app.function(image=image)
+@app.function(image=web_image)
 def simple_test() -> Dict[str, Any]:
     """Simple test function to verify the app is working"""
     return {
@@ -389,7 +784,7 @@ def simple_test() -> Dict[str, Any]:
         "timestamp": time.time()
     }
 
-@app.function(image=image)
+@app.function(image=health_image, secrets=[modal.Secret.from_name("aws-credentials"), modal.Secret.from_name("huggingface-token")])
 def health_check() -> Dict[str, Any]:
     """Health check function to test Modal app configuration"""
     try:
@@ -417,6 +812,12 @@ def health_check() -> Dict[str, Any]:
         except ImportError:
             missing_imports.append("boto3")
             import_status = False
+            
+        try:
+            import audiocraft
+        except ImportError:
+            missing_imports.append("audiocraft")
+            import_status = False
         
         return {
             "status": "healthy" if env_status and import_status else "unhealthy",
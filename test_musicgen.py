@@ -3,103 +3,175 @@
 Test different prompts with the MusicGen Modal app
 """
 
+import os
 import subprocess
-import json
 import re
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import List, Optional, Tuple
+
+try:
+    from musicgen_app import app, MusicGenService, health_check
+except ImportError:
+    # Local dependencies of the app are missing; fall back to the modal CLI
+    app = None
+
+# Resolved once so each CLI run skips the PATH search
+_MODAL = shutil.which("modal") or "modal"
+
+# The CLI inherits the environment (home, proxy, CA, venv and locale settings differ per platform)
+# minus credentials it does not need; Modal uses its own token, and the app's secrets live in Modal
+_SECRET_ENV_PREFIXES = ("AWS_",)
+_SECRET_ENV_KEYS = {"HUGGING_FACE_TOKEN", "HF_TOKEN"}
+_MODAL_ENV = {
+    key: value for key, value in os.environ.items()
+    if not key.startswith(_SECRET_ENV_PREFIXES) and key not in _SECRET_ENV_KEYS
+}
+
+# Matched against raw CLI output lines, so the pattern is bytes
+_S3_RE = re.compile(rb's3://\S+')
+
+# Lines of CLI output kept to explain a failed run
+CLI_TAIL_LINES = 512
 
 def create_music_prompt() -> str:
     prompt = """Energetic, dynamic, high-energy music to be used as a background for a coffee ad, 30 seconds"""
     return prompt.strip()
 
-def test_music_prompt():
-    """Test the default music prompt"""
-    print("🎵 Testing Music Prompt")
+def create_prompt_tests() -> List[Tuple[str, int]]:
+    """(prompt, duration) pairs submitted together in one Modal session"""
+    return [(create_music_prompt(), 30)]
+
+def run_music_prompts(prompt_tests: List[Tuple[str, int]]) -> List[Optional[str]]:
+    """Generate all prompts in the running app session and return their S3 URIs"""
+    print("🎵 Testing Music Prompts")
     print("=" * 40)
     
-    # Get the music prompt
-    prompt = create_music_prompt()
-    print(f"📝 Using music prompt: {prompt}")
+    for prompt, duration in prompt_tests:
+        print(f"📝 Using music prompt ({duration}s): {prompt}")
+        
+    prompts = [prompt for prompt, _ in prompt_tests]
+    durations = [duration for _, duration in prompt_tests]
     
+    s3_uris = []
     try:
-        result = subprocess.run([
-            "modal", "run", "musicgen_app.py::generate_music",
-            "--prompt", prompt,
-            "--duration", "30",
-            "--model-size", "large"
-        ], capture_output=True, text=True, timeout=600)
-        
-        if result.returncode == 0:
-            print("✅ Music generation completed!")
-            return extract_s3_uri(result.stdout + result.stderr)
-        else:
-            print(f"❌ Music generation failed: {result.stderr}")
-            return None
-            
+        # .map submits every prompt at once instead of one call per prompt
+        for result in MusicGenService().generate.map(prompts, durations, return_exceptions=True):
+            if isinstance(result, Exception) or "error" in result:
+                print(f"❌ Music generation failed: {result if isinstance(result, Exception) else result['error']}")
+                s3_uris.append(None)
+            else:
+                print("✅ Music generation completed!")
+                s3_uris.append(result.get("s3_uri"))
     except Exception as e:
         print(f"❌ Error: {e}")
-        return None
+        s3_uris.extend([None] * (len(prompt_tests) - len(s3_uris)))
+        
+    return s3_uris
 
-def test_health_check():
-    """Test the health check function"""
+def check_health(health_call):
+    """Test the health check started with health_check.spawn() in the running app session"""
     print("🏥 Testing Health Check")
     print("=" * 30)
     
     try:
-        result = subprocess.run([
-            "modal", "run", "musicgen_app.py::health_check"
-        ], capture_output=True, text=True, timeout=60)
+        result = health_call.get()
         
-        if result.returncode == 0:
+        if result.get("status") == "healthy":
             print("✅ Health check completed!")
             return True
         else:
-            print(f"❌ Health check failed: {result.stderr}")
+            print(f"❌ Health check failed: {result}")
             return False
             
     except Exception as e:
         print(f"❌ Error: {e}")
         return False
 
-def extract_s3_uri(output: str):
-    """Extract S3 URI from Modal output"""
-    s3_uri_pattern = r's3://[^\s]+'
-    s3_matches = re.findall(s3_uri_pattern, output)
+def run_music_prompt_cli(prompt: str, duration: int):
+    """Test a music prompt through the modal CLI when the app cannot be imported locally"""
+    print(f"📝 Using music prompt ({duration}s): {prompt}")
     
-    if s3_matches:
-        return s3_matches[0]
+    proc = subprocess.Popen([
+        _MODAL, "run", "musicgen_app.py::generate_music",
+        "--prompt", prompt,
+        "--duration", str(duration),
+        "--model-size", "large"
+    ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=_MODAL_ENV)
+    timer = threading.Timer(600, proc.kill)
+    timer.start()
     
-    # Try to find JSON with S3 URI
-    json_pattern = r'\{[^{}]*"s3_uri"[^{}]*\}'
-    matches = re.findall(json_pattern, output)
+    # Only the tail of the log is kept; Modal progress output can be megabytes
+    tail = deque(maxlen=CLI_TAIL_LINES)
     
-    for match in matches:
-        try:
-            data = json.loads(match)
-            if "s3_uri" in data:
-                return data["s3_uri"]
-        except json.JSONDecodeError:
-            continue
-    
-    return None
+    try:
+        # Scan the output as it streams and stop matching at the first S3 URI
+        s3_uri = None
+        for line in proc.stdout:
+            tail.append(line)
+            s3_uri = extract_s3_uri(line)
+            if s3_uri:
+                break
+                
+        # Drain the remaining teardown output so the CLI can exit
+        tail.extend(proc.stdout)
+        returncode = proc.wait()
+        
+        if s3_uri or returncode == 0:
+            print("✅ Music generation completed!")
+            return s3_uri
+        else:
+            print(f"❌ Music generation failed with exit code {returncode}: {b''.join(tail).decode(errors='replace')}")
+            return None
+            
+    except Exception as e:
+        proc.kill()
+        print(f"❌ Error: {e}")
+        return None
+    finally:
+        timer.cancel()
+
+def extract_s3_uri(line: bytes) -> Optional[str]:
+    """Extract S3 URI from a line of Modal CLI output"""
+    match = _S3_RE.search(line)
+    return match.group(0).decode() if match else None
 
 def main():
     """Main function to test different prompts"""
     print("🎵 MusicGen Modal App - Prompt Testing")
     print("=" * 50)
     
+    prompt_tests = create_prompt_tests()
     
-    # Test 1: Default music prompt
-    print("\n3️⃣ Testing default music prompt...")
-    s3_uri = test_music_prompt()
-    if s3_uri:
-        print(f"✅ S3 URI: {s3_uri}")
+    if app is not None:
+        # One app session serves every test, so the CLI and image are resolved once
+        with app.run():
+            # The health check runs in its own container while the prompts generate
+            health_call = health_check.spawn()
+            
+            print("\n1️⃣ Testing music prompts...")
+            s3_uris = run_music_prompts(prompt_tests)
+            
+            print("\n2️⃣ Testing health check...")
+            check_health(health_call)
     else:
-        print("❌ No S3 URI found")
-    
+        print("\n⚠️ musicgen_app could not be imported, using the modal CLI")
+        # Each CLI run waits on its own container, so run them side by side
+        with ThreadPoolExecutor(max_workers=len(prompt_tests)) as executor:
+            s3_uris = list(executor.map(run_music_prompt_cli, *zip(*prompt_tests)))
+            
+    for s3_uri in s3_uris:
+        if s3_uri:
+            print(f"✅ S3 URI: {s3_uri}")
+        else:
+            print("❌ No S3 URI found")
+            
 
     print("\n🎉 Prompt testing completed!")
     print("💡 Check the S3 URIs above to download your generated music files")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()